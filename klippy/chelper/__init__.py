@@ -81,11 +81,20 @@ defs_kin_winch = """
 """
 
 defs_kin_extruder = """
+    struct extruder_move {
+        double print_time, accel_t, cruise_t, decel_t;
+        double axis_d, axis_r, start_v, cruise_v, end_v, accel;
+        double pressure_advance, move_start_pos, max_corner_v;
+    };
+
     struct stepper_kinematics *extruder_stepper_alloc(void);
     void extruder_move_fill(struct move *m, double print_time
         , double accel_t, double cruise_t, double decel_t, double start_pos
         , double start_v, double cruise_v, double accel
         , double extra_accel_v, double extra_decel_v);
+    int32_t extruder_gen_steps_batch(struct stepper_kinematics *sk
+        , struct move *m, struct extruder_move *moves, int count);
+    double extruder_get_extrude_pos(struct stepper_kinematics *sk);
 """
 
 defs_serialqueue = """
@@ -4,12 +4,24 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
+#include <stddef.h> // offsetof
 #include <stdlib.h> // malloc
 #include <string.h> // memset
 #include "compiler.h" // __visible
 #include "itersolve.h" // struct stepper_kinematics
 #include "pyhelper.h" // errorf
 
+struct extruder_stepper {
+    struct stepper_kinematics sk;
+    double extrude_pos;
+};
+
+struct extruder_move {
+    double print_time, accel_t, cruise_t, decel_t;
+    double axis_d, axis_r, start_v, cruise_v, end_v, accel;
+    double pressure_advance, move_start_pos, max_corner_v;
+};
+
 static double
 extruder_calc_position(struct stepper_kinematics *sk, struct move *m
                        , double move_time)
@@ -20,10 +32,18 @@ extruder_calc_position(struct stepper_kinematics *sk, struct move *m
 struct stepper_kinematics * __visible
 extruder_stepper_alloc(void)
 {
-    struct stepper_kinematics *sk = malloc(sizeof(*sk));
-    memset(sk, 0, sizeof(*sk));
-    sk->calc_position = extruder_calc_position;
-    return sk;
+    struct extruder_stepper *es = malloc(sizeof(*es));
+    memset(es, 0, sizeof(*es));
+    es->sk.calc_position = extruder_calc_position;
+    return &es->sk;
+}
+
+// Return the extruder position (including any pressure advance offset)
+double __visible
+extruder_get_extrude_pos(struct stepper_kinematics *sk)
+{
+    struct extruder_stepper *es = container_of(sk, struct extruder_stepper, sk);
+    return es->extrude_pos;
 }
 
 // Populate a 'struct move' with an extruder velocity trapezoid
@@ -52,3 +72,59 @@ extruder_move_fill(struct move *m, double print_time
     // Setup start distance
     m->start_pos.x = start_pos;
 }
+
+// Generate step times for a batch of extruder moves
+int32_t __visible
+extruder_gen_steps_batch(struct stepper_kinematics *sk, struct move *m
+                         , struct extruder_move *moves, int count)
+{
+    struct extruder_stepper *es = container_of(sk, struct extruder_stepper, sk);
+    double start_pos = es->extrude_pos;
+    int i;
+    for (i=0; i<count; i++) {
+        struct extruder_move *em = &moves[i];
+        double axis_d = em->axis_d, cruise_v = em->cruise_v;
+        double accel_t = em->accel_t, decel_t = em->decel_t;
+
+        // Update for pressure advance
+        double extra_accel_v = 0., extra_decel_v = 0.;
+        double pressure_advance = em->pressure_advance;
+        if (pressure_advance) {
+            // Calculate extra_accel_v
+            double prev_pressure_d = start_pos - em->move_start_pos;
+            if (accel_t) {
+                double npd = cruise_v * pressure_advance;
+                double extra_accel_d = npd - prev_pressure_d;
+                if (extra_accel_d > 0.) {
+                    extra_accel_v = extra_accel_d / accel_t;
+                    axis_d += extra_accel_d;
+                    prev_pressure_d += extra_accel_d;
+                }
+            }
+            // Calculate extra_decel_v
+            double emcv = em->max_corner_v;
+            if (decel_t && emcv < cruise_v) {
+                double corner_v = emcv > em->end_v ? emcv : em->end_v;
+                double npd = corner_v * pressure_advance;
+                double extra_decel_d = npd - prev_pressure_d;
+                if (extra_decel_d < 0.) {
+                    axis_d += extra_decel_d;
+                    extra_decel_v = extra_decel_d / decel_t;
+                }
+            }
+        }
+
+        // Generate steps (scaling the toolhead velocities to the extruder)
+        double axis_r = em->axis_r;
+        extruder_move_fill(m, em->print_time, accel_t, em->cruise_t, decel_t
+                           , start_pos, em->start_v * axis_r
+                           , cruise_v * axis_r, em->accel * axis_r
+                           , extra_accel_v, extra_decel_v);
+        int32_t ret = itersolve_gen_steps(sk, m);
+        if (ret)
+            return ret;
+        start_pos += axis_d;
+        es->extrude_pos = start_pos;
+    }
+    return 0;
+}
@@ -52,10 +52,16 @@ class TemplateWrapper:
                  name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise printer.config_error(msg)
+        # A script without any template blocks always renders the same text
+        self.static_output = None
+        if '{' not in script:
+            self.static_output = str(self.template.render({}))
     def create_status_wrapper(self, eventtime=None):
         return GetStatusWrapper(self.printer, eventtime)
     def render(self, context=None):
         if context is None:
+            if self.static_output is not None:
+                return self.static_output
             context = {'printer': self.create_status_wrapper()}
         try:
             return str(self.template.render(context))
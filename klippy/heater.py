@@ -38,6 +38,7 @@ class Heater:
         is_fileoutput = (self.printer.get_start_args().get('debugoutput')
                          is not None)
         self.can_extrude = self.min_extrude_temp <= 0. or is_fileoutput
+        self.can_extrude_callbacks = []
         self.max_power = config.getfloat('max_power', 1., above=0., maxval=1.)
         self.smooth_time = config.getfloat('smooth_time', 2., above=0.)
         self.inv_smooth_time = 1. / self.smooth_time
@@ -92,7 +93,11 @@ class Heater:
             temp_diff = temp - self.smoothed_temp
             adj_time = min(time_diff * self.inv_smooth_time, 1.)
             self.smoothed_temp += temp_diff * adj_time
-            self.can_extrude = (self.smoothed_temp >= self.min_extrude_temp)
+            can_extrude = (self.smoothed_temp >= self.min_extrude_temp)
+            if can_extrude != self.can_extrude:
+                self.can_extrude = can_extrude
+                for cb in self.can_extrude_callbacks:
+                    cb(can_extrude)
         #logging.debug("temp: %.3f %f = %f", read_time, temp)
     # External commands
     def get_pwm_delay(self):
@@ -101,6 +106,8 @@ class Heater:
         return self.max_power
     def get_smooth_time(self):
         return self.smooth_time
+    def register_can_extrude_callback(self, cb):
+        self.can_extrude_callbacks.append(cb)
     def set_temp(self, print_time, degrees):
         if degrees and (degrees < self.min_temp or degrees > self.max_temp):
             raise error("Requested temperature (%.1f) out of range (%.1f:%.1f)"
@@ -4,11 +4,20 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging
-import stepper, homing, chelper
+import stepper, homing, chelper, mcu
 
 EXTRUDE_DIFF_IGNORE = 1.02
 
-class PrinterExtruder:
+class PrinterExtruder(object):
+    __slots__ = (
+        'printer', 'name', 'heater', 'can_extrude', 'stepper',
+        'nozzle_diameter', 'filament_area', 'max_extrude_ratio',
+        'max_cross_section', 'tiny_extrude_d', 'max_e_velocity',
+        'max_e_accel', 'max_e_dist', 'activate_gcode', 'deactivate_gcode',
+        'pressure_advance', 'pressure_advance_lookahead_time',
+        'need_motor_enable', 'cmove', 'sk_extruder', 'new_extruder_moves',
+        'extruder_move_array', 'extruder_gen_steps_batch',
+        'extruder_get_extrude_pos', 'pending_moves', 'move')
     def __init__(self, config, extruder_num):
         self.printer = config.get_printer()
         self.name = config.get_name()
@@ -19,16 +28,22 @@ class PrinterExtruder:
             self.heater = pheater.setup_heater(config, gcode_id)
         else:
             self.heater = pheater.lookup_heater(shared_heater)
+        self.can_extrude = self.heater.can_extrude
+        self.heater.register_can_extrude_callback(self._handle_can_extrude)
         self.stepper = stepper.PrinterStepper(config)
         self.nozzle_diameter = config.getfloat('nozzle_diameter', above=0.)
         filament_diameter = config.getfloat(
             'filament_diameter', minval=self.nozzle_diameter)
         self.filament_area = math.pi * (filament_diameter * .5)**2
+        inv_filament_area = 1. / self.filament_area
         def_max_cross_section = 4. * self.nozzle_diameter**2
-        def_max_extrude_ratio = def_max_cross_section / self.filament_area
+        def_max_extrude_ratio = def_max_cross_section * inv_filament_area
         max_cross_section = config.getfloat(
             'max_extrude_cross_section', def_max_cross_section, above=0.)
-        self.max_extrude_ratio = max_cross_section / self.filament_area
+        self.max_extrude_ratio = max_cross_section * inv_filament_area
+        self.max_cross_section = max_cross_section
+        # Over extrusion is permitted if the amount extruded is tiny
+        self.tiny_extrude_d = self.nozzle_diameter * self.max_extrude_ratio
         logging.info("Extruder max_extrude_ratio=%.6f", self.max_extrude_ratio)
         toolhead = self.printer.lookup_object('toolhead')
         max_velocity, max_accel = toolhead.get_max_velocity()
@@ -50,13 +65,19 @@ class PrinterExtruder:
             'pressure_advance', 0., minval=0.)
         self.pressure_advance_lookahead_time = config.getfloat(
             'pressure_advance_lookahead_time', 0.010, minval=0.)
+        self._update_move_method()
         self.need_motor_enable = True
-        self.extrude_pos = 0.
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
-        self.extruder_move_fill = ffi_lib.extruder_move_fill
-        self.stepper.setup_itersolve('extruder_stepper_alloc')
+        self.sk_extruder = ffi_main.gc(ffi_lib.extruder_stepper_alloc(),
+                                       ffi_lib.free)
+        self.stepper.set_stepper_kinematics(self.sk_extruder)
+        self.new_extruder_moves = ffi_main.new
+        self.extruder_move_array = ffi_main.typeof("struct extruder_move[]")
+        self.extruder_gen_steps_batch = ffi_lib.extruder_gen_steps_batch
+        self.extruder_get_extrude_pos = ffi_lib.extruder_get_extrude_pos
+        self.pending_moves = []
         # Setup SET_PRESSURE_ADVANCE command
         gcode = self.printer.lookup_object('gcode')
         if self.name in ('extruder', 'extruder0'):
@@ -74,8 +95,10 @@ class PrinterExtruder:
         )
     def get_heater(self):
         return self.heater
+    def _handle_can_extrude(self, can_extrude):
+        self.can_extrude = can_extrude
     def set_active(self, print_time, is_active):
-        return self.extrude_pos
+        return self.extruder_get_extrude_pos(self.sk_extruder)
     def get_activate_gcode(self, is_active):
         if is_active:
             return self.activate_gcode.render()
@@ -86,35 +109,48 @@ class PrinterExtruder:
         self.stepper.motor_enable(print_time, 0)
         self.need_motor_enable = True
     def check_move(self, move):
-        move.extrude_r = move.axes_d[3] / move.move_d
+        axes_d = move.axes_d
+        axis_d = axes_d[3]
+        move_d = move.move_d
+        extrude_r = axis_d / move_d
+        # extrude_r may be adjusted during lookahead, so keep the raw
+        # ratio for use when generating steps
+        move.extrude_r = move.extrude_axis_r = extrude_r
         move.extrude_max_corner_v = 0.
-        if not self.heater.can_extrude:
+        # Pressure advance is only applied to extruding XY moves
+        move.is_pa_move = axis_d >= 0. and bool(axes_d[0] or axes_d[1])
+        max_extrude_ratio = self.max_extrude_ratio
+        can_extrude = self.can_extrude
+        if (can_extrude and move.is_kinematic_move
+            and 0. <= extrude_r <= max_extrude_ratio):
+            # Common case - normal extrusion within limits
+            return
+        if not can_extrude:
             raise homing.EndstopError(
                 "Extrude below minimum temp\n"
                 "See the 'min_extrude_temp' config option for details")
-        if not move.is_kinematic_move or move.extrude_r < 0.:
+        if not move.is_kinematic_move or extrude_r < 0.:
             # Extrude only move (or retraction move) - limit accel and velocity
-            if abs(move.axes_d[3]) > self.max_e_dist:
+            if abs(axis_d) > self.max_e_dist:
                 raise homing.EndstopError(
                     "Extrude only move too long (%.3fmm vs %.3fmm)\n"
                     "See the 'max_extrude_only_distance' config"
-                    " option for details" % (move.axes_d[3], self.max_e_dist))
-            inv_extrude_r = 1. / abs(move.extrude_r)
+                    " option for details" % (axis_d, self.max_e_dist))
+            inv_extrude_r = 1. / abs(extrude_r)
             move.limit_speed(self.max_e_velocity * inv_extrude_r
                              , self.max_e_accel * inv_extrude_r)
-        elif move.extrude_r > self.max_extrude_ratio:
-            if move.axes_d[3] <= self.nozzle_diameter * self.max_extrude_ratio:
+        elif extrude_r > max_extrude_ratio:
+            if axis_d <= self.tiny_extrude_d:
                 # Permit extrusion if amount extruded is tiny
-                move.extrude_r = self.max_extrude_ratio
+                move.extrude_r = max_extrude_ratio
                 return
-            area = move.axes_d[3] * self.filament_area / move.move_d
+            area = axis_d * self.filament_area / move_d
             logging.debug("Overextrude: %s vs %s (area=%.3f dist=%.3f)",
-                          move.extrude_r, self.max_extrude_ratio,
-                          area, move.move_d)
+                          extrude_r, max_extrude_ratio, area, move_d)
             raise homing.EndstopError(
                 "Move exceeds maximum extrusion (%.3fmm^2 vs %.3fmm^2)\n"
                 "See the 'max_extrude_cross_section' config option for details"
-                % (area, self.max_extrude_ratio * self.filament_area))
+                % (area, self.max_cross_section))
     def calc_junction(self, prev_move, move):
         extrude = move.axes_d[3]
         prev_extrude = prev_move.axes_d[3]
@@ -122,12 +158,14 @@ class PrinterExtruder:
             if not extrude or not prev_extrude:
                 # Extrude move to non-extrude move - disable lookahead
                 return 0.
-            if ((move.extrude_r > prev_move.extrude_r * EXTRUDE_DIFF_IGNORE
-                 or prev_move.extrude_r > move.extrude_r * EXTRUDE_DIFF_IGNORE)
-                and abs(move.move_d * prev_move.extrude_r - extrude) >= .001):
+            extrude_r = move.extrude_r
+            prev_extrude_r = prev_move.extrude_r
+            if ((extrude_r > prev_extrude_r * EXTRUDE_DIFF_IGNORE
+                 or prev_extrude_r > extrude_r * EXTRUDE_DIFF_IGNORE)
+                and not -.001 < move.move_d * prev_extrude_r - extrude < .001):
                 # Extrude ratio between moves is too different
                 return 0.
-            move.extrude_r = prev_move.extrude_r
+            move.extrude_r = prev_extrude_r
         return move.max_cruise_v2
     def lookahead(self, moves, flush_count, lazy):
         lookahead_t = self.pressure_advance_lookahead_time
@@ -166,61 +204,78 @@ class PrinterExtruder:
                     return i
             move.extrude_max_corner_v = max_corner_v
         return flush_count
-    def move(self, print_time, move):
+    def _update_move_method(self):
+        # Select the move handler once so that the common case of
+        # pressure advance being disabled skips its bookkeeping
+        if self.pressure_advance:
+            self.move = self._move_pa
+        else:
+            self.move = self._move_no_pa
+    # Both move handlers queue the fields of struct extruder_move (see
+    # chelper/kin_extruder.c) in the same order - keep them in sync.
+    # The code is duplicated rather than shared to avoid an extra Python
+    # call per queued move.
+    def _move_pa(self, print_time, move):
         if self.need_motor_enable:
             self.stepper.motor_enable(print_time, 1)
             self.need_motor_enable = False
-        axis_d = move.axes_d[3]
-        axis_r = axis_d / move.move_d
-        accel = move.accel * axis_r
-        start_v = move.start_v * axis_r
-        cruise_v = move.cruise_v * axis_r
-        accel_t, cruise_t, decel_t = move.accel_t, move.cruise_t, move.decel_t
-
-        # Update for pressure advance
-        extra_accel_v = extra_decel_v = 0.
-        start_pos = self.extrude_pos
-        if (axis_d >= 0. and (move.axes_d[0] or move.axes_d[1])
-            and self.pressure_advance):
-            # Calculate extra_accel_v
+        pressure_advance = 0.
+        if move.is_pa_move:
             pressure_advance = self.pressure_advance * move.extrude_r
-            prev_pressure_d = start_pos - move.start_pos[3]
-            if accel_t:
-                npd = move.cruise_v * pressure_advance
-                extra_accel_d = npd - prev_pressure_d
-                if extra_accel_d > 0.:
-                    extra_accel_v = extra_accel_d / accel_t
-                    axis_d += extra_accel_d
-                    prev_pressure_d += extra_accel_d
-            # Calculate extra_decel_v
-            emcv = move.extrude_max_corner_v
-            if decel_t and emcv < move.cruise_v:
-                npd = max(emcv, move.end_v) * pressure_advance
-                extra_decel_d = npd - prev_pressure_d
-                if extra_decel_d < 0.:
-                    axis_d += extra_decel_d
-                    extra_decel_v = extra_decel_d / decel_t
-
-        # Generate steps
-        self.extruder_move_fill(
-            self.cmove, print_time, accel_t, cruise_t, decel_t, start_pos,
-            start_v, cruise_v, accel, extra_accel_v, extra_decel_v)
-        self.stepper.step_itersolve(self.cmove)
-        self.extrude_pos = start_pos + axis_d
+        # Queue move for step generation (pressure advance is applied in C)
+        self.pending_moves.append((
+            print_time, move.accel_t, move.cruise_t, move.decel_t,
+            move.axes_d[3], move.extrude_axis_r, move.start_v, move.cruise_v,
+            move.end_v, move.accel, pressure_advance, move.start_pos[3],
+            move.extrude_max_corner_v))
+    def _move_no_pa(self, print_time, move):
+        if self.need_motor_enable:
+            self.stepper.motor_enable(print_time, 1)
+            self.need_motor_enable = False
+        # Queue move for step generation (no pressure advance)
+        self.pending_moves.append((
+            print_time, move.accel_t, move.cruise_t, move.decel_t,
+            move.axes_d[3], move.extrude_axis_r, move.start_v, move.cruise_v,
+            move.end_v, move.accel, 0., 0., 0.))
+    def flush_moves(self):
+        pending_moves = self.pending_moves
+        if not pending_moves:
+            return
+        self.pending_moves = []
+        # Steps are generated directly on sk_extruder, so the stepper
+        # must not have its kinematics swapped or its moves ignored while
+        # extruder moves are pending
+        stepper = self.stepper
+        if (stepper.get_stepper_kinematics() is not self.sk_extruder
+            or stepper.get_ignore_move()):
+            raise mcu.error("Extruder stepper changed with pending moves")
+        # Generate steps for all queued moves with a single C call
+        moves = self.new_extruder_moves(self.extruder_move_array,
+                                        pending_moves)
+        ret = self.extruder_gen_steps_batch(
+            self.sk_extruder, self.cmove, moves, len(pending_moves))
+        if ret:
+            raise mcu.error("Internal error in stepcompress")
     cmd_SET_PRESSURE_ADVANCE_help = "Set pressure advance parameters"
     def cmd_default_SET_PRESSURE_ADVANCE(self, params):
         extruder = self.printer.lookup_object('toolhead').get_extruder()
         extruder.cmd_SET_PRESSURE_ADVANCE(params)
     def cmd_SET_PRESSURE_ADVANCE(self, params):
-        self.printer.lookup_object('toolhead').get_last_move_time()
         gcode = self.printer.lookup_object('gcode')
         pressure_advance = gcode.get_float(
             'ADVANCE', params, self.pressure_advance, minval=0.)
         pressure_advance_lookahead_time = gcode.get_float(
             'ADVANCE_LOOKAHEAD_TIME', params,
             self.pressure_advance_lookahead_time, minval=0.)
-        self.pressure_advance = pressure_advance
-        self.pressure_advance_lookahead_time = pressure_advance_lookahead_time
+        if (pressure_advance != self.pressure_advance
+            or pressure_advance_lookahead_time
+            != self.pressure_advance_lookahead_time):
+            # Only flush the lookahead queue if the parameters change
+            self.printer.lookup_object('toolhead').get_last_move_time()
+            self.pressure_advance = pressure_advance
+            self.pressure_advance_lookahead_time = (
+                pressure_advance_lookahead_time)
+            self._update_move_method()
         msg = ("pressure_advance: %.6f\n"
                "pressure_advance_lookahead_time: %.6f" % (
                    pressure_advance, pressure_advance_lookahead_time))
@@ -228,9 +283,12 @@ class PrinterExtruder:
         gcode.respond_info(msg, log=False)
 
 # Dummy extruder class used when a printer has no extruder at all
-class DummyExtruder:
+class DummyExtruder(object):
+    __slots__ = ()
     def set_active(self, print_time, is_active):
         return 0.
+    def flush_moves(self):
+        pass
     def motor_off(self, move_time):
         pass
     def check_move(self, move):
@@ -241,18 +299,24 @@ class DummyExtruder:
     def lookahead(self, moves, flush_count, lazy):
         return flush_count
 
+# The dummy extruder is stateless, so a single instance is shared
+DUMMY_EXTRUDER = DummyExtruder()
+
 def add_printer_objects(config):
     printer = config.get_printer()
-    for i in range(99):
-        section = 'extruder%d' % (i,)
-        if not config.has_section(section):
-            if not i and config.has_section('extruder'):
-                pe = PrinterExtruder(config.getsection('extruder'), 0)
-                printer.add_object('extruder0', pe)
-                continue
+    # Map extruder number to config section ("extruder" is "extruder0")
+    sections = {}
+    for section_config in config.get_prefix_sections('extruder'):
+        suffix = section_config.get_name()[len('extruder'):]
+        if not suffix:
+            sections.setdefault(0, section_config)
+        elif suffix.isdigit() and suffix == str(int(suffix)):
+            sections[int(suffix)] = section_config
+    for i in range(min(len(sections), 99)):
+        if i not in sections:
             break
-        pe = PrinterExtruder(config.getsection(section), i)
-        printer.add_object(section, pe)
+        pe = PrinterExtruder(sections[i], i)
+        printer.add_object('extruder%d' % (i,), pe)
 
 def get_printer_extruders(printer):
     out = []
@@ -87,6 +87,8 @@ class MCU_stepper:
         if mcu_pos >= 0.:
             return int(mcu_pos + 0.5)
         return int(mcu_pos - 0.5)
+    def get_stepper_kinematics(self):
+        return self._stepper_kinematics
     def set_stepper_kinematics(self, sk):
         old_sk = self._stepper_kinematics
         self._stepper_kinematics = sk
@@ -94,9 +96,11 @@ class MCU_stepper:
             self._ffi_lib.itersolve_set_stepcompress(
                 sk, self._stepqueue, self._step_dist)
         return old_sk
+    def get_ignore_move(self):
+        return (self._itersolve_gen_steps
+                is not self._ffi_lib.itersolve_gen_steps)
     def set_ignore_move(self, ignore_move):
-        was_ignore = (self._itersolve_gen_steps
-                      is not self._ffi_lib.itersolve_gen_steps)
+        was_ignore = self.get_ignore_move()
         if ignore_move:
             self._itersolve_gen_steps = (lambda *args: 0)
         else:
@@ -77,7 +77,9 @@ class PrinterStepper:
         # Wrappers
         self.step_itersolve = mcu_stepper.step_itersolve
         self.setup_itersolve = mcu_stepper.setup_itersolve
+        self.get_stepper_kinematics = mcu_stepper.get_stepper_kinematics
         self.set_stepper_kinematics = mcu_stepper.set_stepper_kinematics
+        self.get_ignore_move = mcu_stepper.get_ignore_move
         self.set_ignore_move = mcu_stepper.set_ignore_move
         self.calc_position_from_coord = mcu_stepper.calc_position_from_coord
         self.set_position = mcu_stepper.set_position
@@ -52,7 +52,7 @@ class Move:
         if not self.is_kinematic_move or not prev_move.is_kinematic_move:
             return
         # Allow extruder to calculate its maximum junction
-        extruder_v2 = self.toolhead.extruder.calc_junction(prev_move, self)
+        extruder_v2 = self.toolhead.extruder_calc_junction(prev_move, self)
         # Find max velocity using "approximated centripetal velocity"
         axes_d = self.axes_d
         prev_axes_d = prev_move.axes_d
@@ -107,14 +107,15 @@ class Move:
         if self.axes_d[3]:
             self.toolhead.extruder.move(next_move_time, self)
         self.toolhead.update_move_time(
-            self.accel_t + self.cruise_t + self.decel_t)
+            self.accel_t + self.cruise_t + self.decel_t, lazy=True)
 
 LOOKAHEAD_FLUSH_TIME = 0.250
 
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
 class MoveQueue:
-    def __init__(self):
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
         self.extruder_lookahead = None
         self.queue = []
         self.leftover = 0
@@ -180,6 +181,8 @@ class MoveQueue:
         # Generate step times for all moves ready to be flushed
         for move in queue[:move_count]:
             move.move()
+        if move_count:
+            self.toolhead.flush_step_generation()
         # Remove processed moves from the queue
         self.leftover = flush_count - move_count
         del queue[:move_count]
@@ -195,6 +198,10 @@ class MoveQueue:
 
 STALL_TIME = 0.100
 
+# Maximum amount of move time to batch before generating extruder
+# steps and flushing the mcus
+STEP_GEN_BATCH_TIME = 0.050
+
 DRIP_SEGMENT_TIME = 0.050
 DRIP_TIME = 0.150
 class DripModeEndSignal(Exception):
@@ -208,7 +215,7 @@ class ToolHead:
         self.all_mcus = [
             m for n, m in self.printer.lookup_objects(module='mcu')]
         self.mcu = self.all_mcus[0]
-        self.move_queue = MoveQueue()
+        self.move_queue = MoveQueue(self)
         self.commanded_pos = [0., 0., 0., 0.]
         self.printer.register_event_handler("gcode:request_restart",
                                             self._handle_request_restart)
@@ -237,6 +244,7 @@ class ToolHead:
         self.move_flush_time = config.getfloat(
             'move_flush_time', 0.050, above=0.)
         self.print_time = 0.
+        self.step_gen_time = 0.
         self.special_queuing_state = "Flushed"
         self.need_check_stall = -1.
         self.flush_timer = self.reactor.register_timer(self._flush_handler)
@@ -250,7 +258,8 @@ class ToolHead:
         self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
         self.move_fill = ffi_lib.move_fill
         # Create kinematics class
-        self.extruder = kinematics.extruder.DummyExtruder()
+        self.extruder = kinematics.extruder.DUMMY_EXTRUDER
+        self.extruder_calc_junction = self.extruder.calc_junction
         self.move_queue.set_extruder(self.extruder)
         kin_name = config.get('kinematics')
         try:
@@ -275,8 +284,18 @@ class ToolHead:
         self.printer.try_load_module(config, "statistics")
         self.printer.try_load_module(config, "manual_probe")
     # Print time tracking
-    def update_move_time(self, movetime):
+    def update_move_time(self, movetime, lazy=False):
+        # With lazy=True step generation is only flushed every
+        # STEP_GEN_BATCH_TIME - callers must ensure a final
+        # flush_step_generation() (as MoveQueue.flush() does)
         self.print_time += movetime
+        if (not lazy
+            or self.print_time >= self.step_gen_time + STEP_GEN_BATCH_TIME):
+            self.flush_step_generation()
+    def flush_step_generation(self):
+        # Generate any batched extruder steps before flushing the mcus
+        self.step_gen_time = self.print_time
+        self.extruder.flush_moves()
         flush_to_time = self.print_time - self.move_flush_time
         for m in self.all_mcus:
             m.flush_moves(flush_to_time)
@@ -292,7 +311,9 @@ class ToolHead:
         if not self.special_queuing_state:
             return self.print_time
         if self.special_queuing_state == "Drip":
-            # In "Drip" state - wait until ready to send next move
+            # In "Drip" state - send previous moves and wait until
+            # ready to send next move
+            self.flush_step_generation()
             while 1:
                 if self.drip_completion.test():
                     raise DripModeEndSignal()
@@ -415,6 +436,7 @@ class ToolHead:
         self.extruder.set_active(last_move_time, False)
         extrude_pos = extruder.set_active(last_move_time, True)
         self.extruder = extruder
+        self.extruder_calc_junction = extruder.calc_junction
         self.move_queue.set_extruder(extruder)
         self.commanded_pos[3] = extrude_pos
     def get_extruder(self):